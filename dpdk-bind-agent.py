@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-3-Clause
+#
+'''Long-running device agent built on dpdk_bind.
+
+Scans devices once at start-up and then keeps the inventory current from
+kernel uevents, so bind/unbind/info requests are answered from memory
+instead of by a fresh dpdk-bind-and-record.py process.
+
+Requests are newline-delimited JSON objects sent over a local Unix socket;
+each gets one JSON line back:
+
+    {"op": "list"}
+    {"op": "info", "device": "eth1"}
+    {"op": "bind", "device": "eth1", "driver": "vfio-pci", "force": false}
+    {"op": "unbind", "device": "eth1", "force": false}
+    {"op": "refresh"}
+
+Replies are {"ok": true, "result": ...} or
+{"ok": false, "error": "<message>", "type": "<exception class>"}.
+
+"bind" records the device's kernel details first, like
+dpdk-bind-and-record.py --bind does, and "unbind" of a recorded device
+restores its original driver. Unrecorded devices are simply unbound.
+'''
+
+import sys
+import os
+import json
+import errno
+import socket
+import logging
+import argparse
+import selectors
+
+from dpdk_bind import (BindError, DeviceBinder, DeviceInventory,
+                       DeviceNotFoundError, interface_details)
+
+log = logging.getLogger("dpdk-bind-agent")
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_SUBSYSTEMS = ("pci", "net", "module")
+# replies queued for a client that does not read them before it is dropped
+MAX_PENDING_OUTPUT = 1 << 20
+# longest partial request line accepted before the client is dropped
+MAX_PENDING_INPUT = 1 << 20
+
+
+def parse_uevent(data):
+    '''Split a raw kernel uevent ("action@devpath\\0KEY=VALUE\\0...") into a
+    dict of its keys. Returns None for udev-rebroadcast messages.'''
+    if data.startswith(b"libudev"):
+        return None
+    fields = data.split(b"\0")
+    event = {}
+    for field in fields[1:]:
+        key, sep, value = field.decode("utf8", "replace").partition("=")
+        if sep:
+            event[key] = value
+    return event
+
+
+class Agent:
+    '''Owns the inventory, the binder and the records of original drivers'''
+
+    def __init__(self, inventory, binder, records_file):
+        self.inventory = inventory
+        self.binder = binder
+        self.records_file = records_file
+        # original device details keyed by PCI address
+        self.records = {}
+        if records_file and os.path.exists(records_file):
+            with open(records_file) as f:
+                self.records = json.load(f)
+
+    def _save_records(self):
+        if not self.records_file:
+            return
+        with open(self.records_file, "w", encoding="utf-8") as f:
+            json.dump(self.records, f, ensure_ascii=False, indent=4)
+
+    def _lookup(self, name):
+        '''Resolve a device name, falling back to recorded interface names
+        since a device bound to a DPDK driver no longer has one'''
+        try:
+            return self.inventory.pci_from_dev_name(name)
+        except DeviceNotFoundError:
+            for dev_id, record in self.records.items():
+                if record.get("device") == name:
+                    return dev_id
+            raise
+
+    # -- uevents ------------------------------------------------------------
+
+    def handle_uevent(self, event):
+        inv = self.inventory
+        subsystem = event.get("SUBSYSTEM")
+        action = event.get("ACTION")
+        if subsystem == "pci":
+            dev_id = event.get("PCI_SLOT_NAME") or \
+                os.path.basename(event.get("DEVPATH", ""))
+            if action == "add" or dev_id not in inv.devices:
+                inv.refresh_device(dev_id)
+            elif action == "remove":
+                inv.devices.pop(dev_id, None)
+            else:
+                inv.update_from_sysfs(dev_id)
+        elif subsystem == "net":
+            # /devices/pci0000:00/0000:00:03.0/net/eth1
+            parts = event.get("DEVPATH", "").split("/")
+            owners = [p for p in parts if p in inv.devices]
+            for dev_id in owners:
+                inv.update_from_sysfs(dev_id)
+            if action in ("add", "remove", "move"):
+                inv.refresh_protection()
+        elif subsystem == "module":
+            inv.refresh_modules()
+            for dev_id in inv.devices:
+                inv.update_from_sysfs(dev_id)
+
+    # -- requests -----------------------------------------------------------
+
+    def handle_request(self, req):
+        op = req.get("op")
+        if op == "list":
+            return self.inventory.devices
+        if op == "refresh":
+            self.inventory.refresh()
+            return self.inventory.devices
+        if "device" not in req:
+            raise BindError("'%s' requires a device" % op)
+
+        dev_id = self._lookup(req["device"])
+        force = bool(req.get("force", False))
+        if op == "info":
+            return {"device": self.inventory.devices[dev_id],
+                    "record": self.records.get(dev_id)}
+        if op == "bind":
+            driver = req.get("driver")
+            if not driver:
+                raise BindError("'bind' requires a driver")
+            self.binder.validate_driver_name(driver)
+            dev = self.inventory.devices[dev_id]
+            recorded = dev_id not in self.records and dev["Interface"]
+            if recorded:
+                self.records[dev_id] = interface_details(
+                    dev["Interface"].split(",")[0], dev)
+            try:
+                result = self.binder.bind(dev_id, driver, force)
+            except BindError:
+                if recorded:
+                    del self.records[dev_id]
+                raise
+            self._save_records()
+            return result.to_dict()
+        if op == "unbind":
+            record = self.records.get(dev_id)
+            if record is None:
+                return self.binder.unbind(dev_id, force).to_dict()
+            result = self.binder.bind(dev_id, record["driver"], force)
+            del self.records[dev_id]
+            self._save_records()
+            return result.to_dict()
+        raise BindError("unknown op '%s'" % op)
+
+    def reply(self, line):
+        try:
+            req = json.loads(line)
+            if not isinstance(req, dict):
+                raise ValueError("request must be a JSON object")
+            return {"ok": True, "result": self.handle_request(req)}
+        except (BindError, ValueError, OSError) as err:
+            return {"ok": False, "error": str(err),
+                    "type": type(err).__name__}
+        except Exception as err:
+            # keep serving; a bad request must not take the agent down
+            log.exception("request %r failed", line)
+            return {"ok": False, "error": str(err),
+                    "type": type(err).__name__}
+
+
+def open_uevent_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                         NETLINK_KOBJECT_UEVENT)
+    # group 1 carries the kernel's own broadcasts
+    sock.bind((0, 1))
+    sock.setblocking(False)
+    return sock
+
+
+def open_control_socket(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, 0o600)
+    sock.listen()
+    sock.setblocking(False)
+    return sock
+
+
+def handle_uevents(agent, uevents):
+    '''Read one uevent and apply it. Never raises: a failure here must not
+    take the agent down.'''
+    try:
+        event = parse_uevent(uevents.recv(65536))
+    except BlockingIOError:
+        return
+    except OSError as err:
+        if err.errno != errno.ENOBUFS:
+            log.error("reading uevents failed: %s", err)
+            return
+        # the kernel dropped events, so the inventory can no longer be
+        # trusted; rescan everything
+        log.warning("uevent socket overflowed, rescanning devices")
+        try:
+            agent.inventory.refresh()
+        except Exception:
+            log.exception("rescan after uevent overflow failed")
+        return
+    if event and event.get("SUBSYSTEM") in UEVENT_SUBSYSTEMS:
+        log.debug("uevent %s", event)
+        try:
+            agent.handle_uevent(event)
+        except Exception:
+            log.exception("uevent %r failed", event)
+
+
+class Client:
+    '''A control connection. The socket is non-blocking; replies are queued
+    in "outbuf" and flushed whenever the socket is writable, so a client
+    that stops reading never stalls the event loop.'''
+
+    __slots__ = ("conn", "inbuf", "outbuf")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.inbuf = b""
+        self.outbuf = b""
+
+    def read(self, agent):
+        '''Receive and answer complete request lines. Returns False once the
+        peer has closed the connection or sent an overlong line.'''
+        try:
+            data = self.conn.recv(65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        if not data:
+            return False
+        self.inbuf += data
+        while b"\n" in self.inbuf:
+            line, self.inbuf = self.inbuf.split(b"\n", 1)
+            if line.strip():
+                self.outbuf += json.dumps(agent.reply(line)).encode() + b"\n"
+        if len(self.inbuf) > MAX_PENDING_INPUT:
+            log.warning("client sent %d bytes without a newline, dropping it",
+                        len(self.inbuf))
+            return False
+        return True
+
+    def flush(self):
+        '''Send as much queued output as the socket takes. Returns False if
+        the connection failed.'''
+        try:
+            sent = self.conn.send(self.outbuf)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        self.outbuf = self.outbuf[sent:]
+        return True
+
+
+def serve(agent, uevents, control):
+    '''Single-threaded event loop: uevents and requests are handled in the
+    order they arrive, so the inventory never needs locking'''
+    sel = selectors.DefaultSelector()
+    sel.register(uevents, selectors.EVENT_READ, "uevent")
+    sel.register(control, selectors.EVENT_READ, "accept")
+
+    def drop(client):
+        sel.unregister(client.conn)
+        client.conn.close()
+
+    while True:
+        for key, mask in sel.select():
+            if key.data == "uevent":
+                handle_uevents(agent, uevents)
+                continue
+            if key.data == "accept":
+                try:
+                    conn, _ = control.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(False)
+                sel.register(conn, selectors.EVENT_READ, Client(conn))
+                continue
+
+            client = key.data
+            if mask & selectors.EVENT_READ and not client.read(agent):
+                drop(client)
+                continue
+            if client.outbuf and not client.flush():
+                drop(client)
+                continue
+            if len(client.outbuf) > MAX_PENDING_OUTPUT:
+                log.warning("client is not reading its replies, dropping it")
+                drop(client)
+                continue
+            events = selectors.EVENT_READ
+            if client.outbuf:
+                events |= selectors.EVENT_WRITE
+            if events != key.events:
+                sel.modify(client.conn, events, client)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Agent serving device bind/unbind/info over a Unix socket',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+---------
+
+Start the agent:
+        %(prog)s --noiommu-mode
+
+Bind eth1 to vfio-pci and later restore it:
+        echo '{"op": "bind", "device": "eth1", "driver": "vfio-pci"}' | socat - UNIX-CONNECT:/run/dpdk-bind-agent.sock
+        echo '{"op": "unbind", "device": "eth1"}' | socat - UNIX-CONNECT:/run/dpdk-bind-agent.sock
+""")
+    parser.add_argument(
+        '-s',
+        '--socket',
+        default='/run/dpdk-bind-agent.sock',
+        help="Path of the control socket (default: %(default)s)")
+    parser.add_argument(
+        '-r',
+        '--records',
+        default='/run/dpdk-bind-agent.json',
+        help="File keeping the original driver of bound devices "
+             "(default: %(default)s)")
+    parser.add_argument(
+        '--noiommu-mode',
+        action='store_true',
+        help="If IOMMU is not available, enable no IOMMU mode for VFIO drivers")
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        help="Log every uevent received")
+    return parser.parse_args()
+
+
+def main():
+    '''program main function'''
+    opt = parse_args()
+    if os.geteuid() != 0:
+        sys.exit("You must run this script with SUDO or be root")
+    logging.basicConfig(level=logging.DEBUG if opt.verbose else logging.INFO,
+                        format="%(levelname)s: %(message)s")
+
+    inventory = DeviceInventory()
+    # subscribe before scanning so no event between the two is lost
+    uevents = open_uevent_socket()
+    inventory.refresh()
+    if not inventory.loaded_dpdk_drivers():
+        log.warning("no supported DPDK kernel modules are loaded")
+    agent = Agent(inventory, DeviceBinder(inventory, noiommu=opt.noiommu_mode),
+                  opt.records)
+
+    control = open_control_socket(opt.socket)
+    log.info("serving %d devices on %s", len(inventory.devices), opt.socket)
+    try:
+        serve(agent, uevents, control)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        control.close()
+        os.unlink(opt.socket)
+
+
+if __name__ == "__main__":
+    main()
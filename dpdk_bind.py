@@ -0,0 +1,553 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2010-2014 Intel Corporation
+#
+'''In-process API for inspecting network devices and binding them to DPDK
+drivers.
+
+This is the library behind dpdk-bind-and-record.py and dpdk-bind-agent.py.
+Nothing in here prints or exits; failures are raised as BindError subclasses
+and operations return BindResult objects.
+
+    inv = DeviceInventory()
+    inv.refresh()
+    binder = DeviceBinder(inv, noiommu=True)
+    result = binder.bind(inv.pci_from_dev_name("eth1"), "vfio-pci")
+'''
+
+import json
+import logging
+import os
+import platform
+import subprocess
+
+from dataclasses import dataclass, asdict
+from os.path import exists
+
+log = logging.getLogger(__name__)
+
+SAVED_DATA_FILE = "dpdk-bind-and-record.json"
+
+NETWORK_CLASS = {'Class': '02', 'Vendor': None, 'Device': None,
+                 'SVendor': None, 'SDevice': None}
+NETWORK_DEVICES = [NETWORK_CLASS]
+
+# list of supported DPDK drivers
+DPDK_DRIVERS = ["igb_uio", "vfio-pci", "uio_pci_generic"]
+
+SYSFS_PCI_DEVICES = "/sys/bus/pci/devices"
+SYSFS_PCI_DRIVERS = "/sys/bus/pci/drivers"
+NOIOMMU_PARAM = "/sys/module/vfio/parameters/enable_unsafe_noiommu_mode"
+
+
+class BindError(Exception):
+    '''Base class for all errors raised by this module'''
+
+
+class DeviceNotFoundError(BindError, ValueError):
+    '''The given name does not match any known device'''
+
+
+class DriverNotLoadedError(BindError):
+    '''The requested driver's kernel module is not loaded'''
+
+
+class IommuError(BindError):
+    '''No IOMMU is present and noiommu mode could not be used'''
+
+
+class ProtectedDeviceError(BindError):
+    '''The device carries the default route or is the only interface'''
+
+
+@dataclass
+class BindResult:
+    '''Outcome of a bind or unbind operation. "changed" is False when the
+    device was already in the requested state and nothing was written.'''
+    dev_id: str
+    driver: str
+    previous_driver: str
+    changed: bool
+    message: str = ""
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def _write_sysfs(filename, value, what):
+    '''Write "value" to a sysfs attribute, raising BindError on failure'''
+    try:
+        with open(filename, "a") as f:
+            f.write(value)
+    except OSError as err:
+        raise BindError("%s failed - cannot write to %s: %s"
+                        % (what, filename, err)) from err
+
+
+def has_iommu():
+    '''Check if IOMMU is enabled on system'''
+    iommu_path = "/sys/class/iommu"
+    return exists(iommu_path) and len(os.listdir(iommu_path)) > 0
+
+
+def enable_noiommu_mode(allow):
+    '''Check and enable the noiommu mode for VFIO drivers. Returns True if
+    the mode had to be switched on.'''
+    try:
+        with open(NOIOMMU_PARAM, "r") as f:
+            if f.read(1) in ("1", "y", "Y"):
+                return False  # Already enabled
+    except OSError as err:
+        raise IommuError("failed to check unsafe noiommu mode - "
+                         "Cannot open %s: %s" % (NOIOMMU_PARAM, err)) from err
+
+    if not allow:
+        raise IommuError("IOMMU support is disabled, use --noiommu-mode for "
+                         "binding in noiommu mode")
+
+    try:
+        with open(NOIOMMU_PARAM, "w") as f:
+            f.write("1")
+    except OSError as err:
+        raise IommuError("failed to enable unsafe noiommu mode - "
+                         "Cannot open %s: %s" % (NOIOMMU_PARAM, err)) from err
+    log.warning("enabling unsafe no IOMMU mode for VFIO drivers")
+    return True
+
+
+def current_driver(dev_id):
+    '''Return the driver a device is bound to according to sysfs, or ""'''
+    link = os.path.join(SYSFS_PCI_DEVICES, dev_id, "driver")
+    if not os.path.islink(link):
+        return ""
+    return os.path.basename(os.readlink(link))
+
+
+def interface_names(dev_id):
+    '''Return the kernel interface names of a device as a comma separated
+    string, the same format lspci based scans use'''
+    for base, dirs, _ in os.walk(os.path.join(SYSFS_PCI_DEVICES, dev_id)):
+        if "net" in dirs:
+            return ",".join(os.listdir(os.path.join(base, "net")))
+    return ""
+
+
+def default_route_interface():
+    '''Return the interface carrying the default route, or None'''
+    try:
+        default_route = subprocess.check_output(
+            ["ip", "-o", "route", "show", "default"],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except subprocess.CalledProcessError:
+        return None  # No default route
+    # Parse "default via X.X.X.X dev <interface> ..."
+    parts = default_route.split()
+    for i, part in enumerate(parts):
+        if part == "dev" and i + 1 < len(parts):
+            return parts[i + 1]
+    return None
+
+
+def default_gateway(iface):
+    '''Return the default gateway reached through "iface", or ""'''
+    try:
+        default_route = subprocess.check_output(
+            ["ip", "-o", "route", "show", "default", "dev", iface],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except subprocess.CalledProcessError:
+        return ""  # No default route on this interface
+    parts = default_route.split()
+    for i, part in enumerate(parts):
+        if part == "via" and i + 1 < len(parts):
+            return parts[i + 1]
+    return ""
+
+
+def real_interfaces():
+    '''Return all non-loopback link names, or None if "ip" failed'''
+    try:
+        all_interfaces = subprocess.check_output(
+            ["ip", "-o", "link", "show"],
+            stderr=subprocess.DEVNULL
+        ).decode().strip().splitlines()
+    except subprocess.CalledProcessError:
+        return None
+    return [
+        line.split(":")[1].strip().split("@")[0]
+        for line in all_interfaces
+        if "loopback" not in line.lower() and ": lo:" not in line
+    ]
+
+
+def device_type_match(dev, devices_type):
+    for i in range(len(devices_type)):
+        param_count = len(
+            [x for x in devices_type[i].values() if x is not None])
+        match_count = 0
+        if dev["Class"][0:2] == devices_type[i]["Class"]:
+            match_count = match_count + 1
+            for key in devices_type[i].keys():
+                if key != 'Class' and devices_type[i][key]:
+                    value_list = devices_type[i][key].split(',')
+                    for value in value_list:
+                        if value.strip(' ') == dev[key]:
+                            match_count = match_count + 1
+            # count must be the number of non None parameters to match
+            if match_count == param_count:
+                return True
+    return False
+
+
+def interface_details(iface, dev):
+    '''Build the record saved by dpdk-bind-and-record.py for kernel interface
+    "iface" backed by inventory entry "dev"'''
+    import netifaces
+
+    if iface not in netifaces.interfaces():
+        raise DeviceNotFoundError(
+            "%s is not a valid network interface. Valid interfaces are: %s"
+            % (iface, netifaces.interfaces()))
+    ifaddrs = netifaces.ifaddresses(iface)
+    details = {
+        "device": iface,
+        "pci": dev["Slot_str"],
+        "driver": dev["Driver_str"],
+        "mac": ifaddrs.get(netifaces.AF_LINK, [{}])[0].get("addr", ""),
+        "ipv4": "",
+        "netmask": "",
+    }
+    if netifaces.AF_INET in ifaddrs:
+        IPv4 = ifaddrs[netifaces.AF_INET][0]
+        details["ipv4"] = IPv4.get("addr", "")
+        details["netmask"] = IPv4.get("netmask", "")
+    details["gateway"] = default_gateway(iface)
+    return details
+
+
+def save_device_details(details, path=SAVED_DATA_FILE):
+    '''Writes device details to json file'''
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(details, f, ensure_ascii=False, indent=4)
+
+
+def load_device_details(path=SAVED_DATA_FILE):
+    '''Reads device details from json file. Raises FileNotFoundError if
+    nothing was recorded.'''
+    with open(path) as f:
+        return json.load(f)
+
+
+class DeviceInventory:
+    '''The set of PCI devices of a given type, indexed by PCI address
+    (domain:bus:slot.func). Each value is a dictionary of device properties
+    using the lspci field names, with "_str" suffixes for the text forms.
+
+    A full refresh() runs lspci once; afterwards single devices can be kept
+    current with refresh_device() and update_from_sysfs(), which is what the
+    agent does in response to kernel uevents.'''
+
+    def __init__(self, devices_type=None, dpdk_drivers=None):
+        self.devices_type = devices_type or NETWORK_DEVICES
+        self.dpdk_drivers = list(dpdk_drivers or DPDK_DRIVERS)
+        self.devices = {}
+        self._loaded_modules = None
+
+    # -- kernel modules -----------------------------------------------------
+
+    def refresh_modules(self):
+        '''Re-read the list of loaded kernel modules'''
+        # Get list of sysfs modules (both built-in and dynamically loaded)
+        sysfs_path = '/sys/module/'
+        sysfs_mods = [m for m in os.listdir(sysfs_path)
+                      if os.path.isdir(os.path.join(sysfs_path, m))]
+
+        # special case for vfio_pci (module is named vfio-pci,
+        # but its .ko is named vfio_pci)
+        mods = set(a if a != 'vfio_pci' else 'vfio-pci' for a in sysfs_mods)
+
+        # add built-in modules as loaded
+        release = platform.uname().release
+        filename = os.path.join("/lib/modules/", release, "modules.builtin")
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    mods.update(os.path.splitext(os.path.basename(mod.strip()))[0]
+                                for mod in f)
+            except IOError:
+                log.warning("cannot read list of built-in kernel modules")
+        self._loaded_modules = mods
+
+    def module_is_loaded(self, module):
+        '''check if a specific kernel module is loaded'''
+        if module in ('vfio_pci', 'vfio-pci'):
+            module = 'vfio-pci'
+        if self._loaded_modules is None:
+            self.refresh_modules()
+        return module in self._loaded_modules
+
+    def loaded_dpdk_drivers(self):
+        '''Return the supported DPDK drivers whose modules are loaded'''
+        return [d for d in self.dpdk_drivers if self.module_is_loaded(d)]
+
+    # -- devices ------------------------------------------------------------
+
+    def _scan_lspci(self, slot=None):
+        '''Run lspci in machine readable format, with numeric IDs and
+        strings, and return the matching devices keyed by slot'''
+        cmd = ["lspci", "-Dvmmnnk"]
+        if slot is not None:
+            cmd += ["-s", slot]
+        found = {}
+        dev = {}
+        # a trailing empty line terminates the last record
+        for dev_line in subprocess.check_output(cmd).splitlines() + [b""]:
+            if not dev_line:
+                if dev and device_type_match(dev, self.devices_type):
+                    # Replace "Driver" with "Driver_str" to have consistency of
+                    # of dictionary key names
+                    if "Driver" in dev:
+                        dev["Driver_str"] = dev.pop("Driver")
+                    if "Module" in dev:
+                        dev["Module_str"] = dev.pop("Module")
+                    found[dev["Slot"]] = dev
+                # Clear previous device's data
+                dev = {}
+            else:
+                name, value = dev_line.decode("utf8").split("\t", 1)
+                value_list = value.rsplit(' ', 1)
+                if value_list:
+                    # String stored in <name>_str
+                    dev[name.rstrip(":") + '_str'] = value_list[0]
+                # Numeric IDs
+                dev[name.rstrip(":")] = value_list[len(value_list) - 1] \
+                    .rstrip("]").lstrip("[")
+        return found
+
+    def _fill_module_str(self, dev):
+        '''add the loaded DPDK drivers to the list of supporting modules and
+        make sure the driver and module strings do not have any duplicates'''
+        drivers = self.loaded_dpdk_drivers()
+        modules = [m for m in dev.get("Module_str", "").split(",") if m]
+        for driver in drivers:
+            if driver not in modules:
+                modules.append(driver)
+        if dev.get("Driver_str") in modules:
+            modules.remove(dev["Driver_str"])
+        dev["Module_str"] = ",".join(modules)
+
+    def refresh(self):
+        '''Rescan all devices'''
+        self.refresh_modules()
+        self.devices = self._scan_lspci()
+        for dev_id, dev in self.devices.items():
+            dev["Interface"] = interface_names(dev_id)
+            self._fill_module_str(dev)
+        self.refresh_protection()
+
+    def refresh_device(self, dev_id):
+        '''Rescan a single device, e.g. after hotplug. The device is dropped
+        from the inventory if it no longer exists.'''
+        try:
+            found = self._scan_lspci(dev_id)
+        except subprocess.CalledProcessError:
+            found = {}
+        if dev_id not in found:
+            self.devices.pop(dev_id, None)
+            return None
+        dev = found[dev_id]
+        dev["Interface"] = interface_names(dev_id)
+        self._fill_module_str(dev)
+        self.devices[dev_id] = dev
+        self.refresh_protection()
+        return dev
+
+    def update_from_sysfs(self, dev_id):
+        '''Refresh the driver and interface names of a known device without
+        running lspci'''
+        dev = self.devices.get(dev_id)
+        if dev is None:
+            return None
+        dev["Driver_str"] = current_driver(dev_id)
+        dev["Interface"] = interface_names(dev_id)
+        self._fill_module_str(dev)
+        return dev
+
+    def refresh_protection(self):
+        '''Mark the devices that must not be taken from the kernel. Only
+        protect an interface if it's the default route interface or the only
+        network interface on the system.'''
+        if self.devices_type != NETWORK_DEVICES:
+            return
+        default_if = default_route_interface()
+        interfaces = real_interfaces()
+        single_interface = interfaces is not None and len(interfaces) == 1
+        for dev in self.devices.values():
+            iface_names = dev["Interface"].split(",")
+            is_default = default_if and default_if in iface_names
+            is_only_interface = single_interface and any(
+                iface in interfaces for iface in iface_names
+            )
+            dev["Ssh_if"] = bool(is_default or is_only_interface)
+            dev["Active"] = ""
+            if is_default:
+                dev["Active"] = "*Default Route*"
+            elif is_only_interface:
+                dev["Active"] = "*Only Interface*"
+
+    def has_driver(self, dev_id):
+        '''return true if a device is assigned to a driver. False otherwise'''
+        return self.devices[dev_id].get("Driver_str", "") != ""
+
+    def pci_from_dev_name(self, dev_name):
+        '''Take a device "name" - a string passed in by user to identify a NIC
+        device, and determine the device id - i.e. the domain:bus:slot.func -
+        for it, which can then be used to index into the devices dict'''
+        # check if it's already a suitable index
+        if dev_name in self.devices:
+            return dev_name
+        # check if it's an index just missing the domain part
+        if "0000:" + dev_name in self.devices:
+            return "0000:" + dev_name
+
+        # check if it's an interface name, e.g. eth1
+        for dev_id, dev in self.devices.items():
+            if dev_name in dev["Interface"].split(","):
+                return dev_id
+        # if nothing else matches - error
+        raise DeviceNotFoundError(
+            "Unknown device: %s. "
+            "Please specify device in \"bus:slot.func\" format" % dev_name)
+
+
+class DeviceBinder:
+    '''Binds and unbinds devices of a DeviceInventory, keeping the inventory
+    in step with what was written to sysfs'''
+
+    def __init__(self, inventory, noiommu=False):
+        self.inventory = inventory
+        self.noiommu = noiommu
+
+    def validate_driver_name(self, driver_name):
+        '''Validate that the driver name is not accidentally a device name.
+        A common user error is to forget to specify the driver.'''
+        try:
+            self.inventory.pci_from_dev_name(driver_name)
+        except DeviceNotFoundError:
+            return
+        raise BindError("Driver '%s' does not look like a valid driver. "
+                        "Did you forget to specify the driver to bind "
+                        "devices to?" % driver_name)
+
+    def _check_protected(self, dev_id, force):
+        dev = self.inventory.devices[dev_id]
+        # prevent disconnection of our ssh session
+        if dev.get("Ssh_if") and not force:
+            raise ProtectedDeviceError(
+                "interface %s is %s. Not modifying. Use --force to override."
+                % (dev_id, dev.get("Active") or "active"))
+
+    def unbind(self, dev_id, force=False):
+        '''Unbind the device identified by "dev_id" from its current driver'''
+        inv = self.inventory
+        dev = inv.devices[dev_id]
+        if not inv.has_driver(dev_id):
+            return BindResult(dev_id, "", "", False,
+                              "%s %s %s is not currently managed by any driver"
+                              % (dev["Slot"], dev["Device_str"],
+                                 dev["Interface"]))
+        self._check_protected(dev_id, force)
+
+        previous = dev["Driver_str"]
+        log.info("unbinding %s from device %s", previous, dev_id)
+        _write_sysfs(os.path.join(SYSFS_PCI_DRIVERS, previous, "unbind"),
+                     dev_id, "unbind of %s" % dev_id)
+        inv.update_from_sysfs(dev_id)
+        return BindResult(dev_id, "", previous, True)
+
+    def bind(self, dev_id, driver, force=False):
+        '''Bind the device given by "dev_id" to the driver "driver". If the
+        device is already bound to a different driver, it will be unbound
+        first, and rebound to it if the new bind fails.'''
+        inv = self.inventory
+        dev = inv.devices[dev_id]
+
+        # Check driver is loaded before attempting to bind
+        if not inv.module_is_loaded(driver.replace('-', '_')):
+            raise DriverNotLoadedError("Driver '%s' is not loaded." % driver)
+
+        # Check for IOMMU support when binding to vfio-pci
+        if driver == "vfio-pci" and not has_iommu():
+            enable_noiommu_mode(self.noiommu)
+
+        self._check_protected(dev_id, force)
+
+        # unbind any existing drivers we don't want
+        previous = dev.get("Driver_str", "")
+        if previous == driver:
+            return BindResult(dev_id, driver, previous, False,
+                              "%s already bound to driver %s, skipping"
+                              % (dev_id, driver))
+        if previous:
+            self.unbind(dev_id, force)
+
+        try:
+            self._bind_sysfs(dev_id, dev, driver)
+        except BindError:
+            if previous:  # restore any previous driver
+                self._restore(dev_id, previous)
+            raise
+        inv.update_from_sysfs(dev_id)
+        return BindResult(dev_id, driver, previous, True)
+
+    def _restore(self, dev_id, driver):
+        try:
+            self._bind_sysfs(dev_id, self.inventory.devices[dev_id], driver)
+        except BindError as err:
+            log.error("failed to restore %s to driver %s: %s",
+                      dev_id, driver, err)
+        self.inventory.update_from_sysfs(dev_id)
+
+    def _bind_sysfs(self, dev_id, dev, driver):
+        log.info("binding device %s to driver %s", dev_id, driver)
+        what = "bind of %s" % dev_id
+
+        # For kernels >= 3.15 driver_override can be used to specify the driver
+        # for a device rather than relying on the driver to provide a positive
+        # match of the device.  The existing process of looking up
+        # the vendor and device ID, adding them to the driver new_id,
+        # will erroneously bind other devices too which has the additional
+        # burden of unbinding those devices
+        override = os.path.join(SYSFS_PCI_DEVICES, dev_id, "driver_override")
+        if driver in self.inventory.dpdk_drivers:
+            if exists(override):
+                _write_sysfs(override, driver, what)
+            # For kernels < 3.15 use new_id to add PCI id's to the driver
+            else:
+                # Convert Device and Vendor Id to int to write to new_id
+                _write_sysfs(os.path.join(SYSFS_PCI_DRIVERS, driver, "new_id"),
+                             "%04x %04x" % (int(dev["Vendor"], 16),
+                                            int(dev["Device"], 16)),
+                             what)
+
+        # do the bind by writing to /sys
+        try:
+            _write_sysfs(os.path.join(SYSFS_PCI_DRIVERS, driver, "bind"),
+                         dev_id, what)
+        except BindError:
+            # for some reason, closing dev_id after adding a new PCI ID to
+            # new_id results in IOError. however, if the device was
+            # successfully bound, we don't care for any errors
+            if current_driver(dev_id) != driver:
+                raise
+
+        # For kernels > 3.15 driver_override is used to bind a device to a
+        # driver. Overwrite driver_override with empty string so that the
+        # device can be bound to any other driver later
+        if exists(override):
+            _write_sysfs(override, "\00", what)
+
+        # Verify that binding actually succeeded
+        if current_driver(dev_id) != driver:
+            raise BindError("bind appeared to succeed but device %s is not "
+                            "bound to %s" % (dev_id, driver))
@@ -1,8 +1,80 @@
 #!/bin/bash
 set -e
 
-cd ~/vpp/build-root/ || {
-  echo "ERROR: Failed to enter vpp/build-root"
+#######################################
+# Default values
+#######################################
+BUILD_DIR="${HOME}/vpp/build-root"
+FORCE=false
+DRY_RUN=false
+
+# Packages in dependency order. Only the ones that differ from what dpkg
+# reports as installed are passed to a single dpkg transaction.
+PACKAGES=(
+  libvppinfra
+  libvppinfra-dev
+  vpp
+  vpp-dev
+  vpp-crypto-engines
+  vpp-plugin-core
+  vpp-plugin-devtools
+  vpp-plugin-dpdk
+)
+
+#######################################
+# Usage
+#######################################
+usage() {
+  cat <<EOF >&2
+Usage: $0 [OPTIONS]
+
+Install the VPP .deb packages from a build tree, skipping packages whose
+version, file and conffile checksums and maintainer scripts already match
+the installed ones. Other control fields (e.g. Depends) are not compared;
+use --force after changing only those.
+
+Options:
+  -d, --dir <DIR>     Directory holding the .deb files (default: ${BUILD_DIR})
+  -f, --force         Reinstall all packages even if unchanged
+  -n, --dry-run       Only report which packages would be installed
+  -h, --help          Show this help message
+EOF
+  exit 1
+}
+
+#######################################
+# Argument parsing
+#######################################
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -d|--dir)
+      if [ -z "$2" ] || [[ "$2" == -* ]]; then
+        echo "Error: --dir requires an argument" >&2
+        exit 1
+      fi
+      BUILD_DIR="$2"
+      shift 2
+      ;;
+    -f|--force)
+      FORCE=true
+      shift
+      ;;
+    -n|--dry-run)
+      DRY_RUN=true
+      shift
+      ;;
+    -h|--help)
+      usage
+      ;;
+    *)
+      echo "Error: Unknown option: $1" >&2
+      usage
+      ;;
+  esac
+done
+
+cd "$BUILD_DIR" || {
+  echo "ERROR: Failed to enter $BUILD_DIR"
   exit 1
 }
 
@@ -22,13 +94,159 @@ if [[ -z "$ver" ]]; then
   exit 1
 fi
 
-echo "Installing VPP packages with version: $ver"
+#######################################
+# Helper functions
+#######################################
+
+# Print the path dpkg keeps a control file of an installed package under
+dpkg_info_file() {
+  local pkg="$1" arch="$2" name="$3" f
+  for f in "/var/lib/dpkg/info/${pkg}:${arch}.${name}" "/var/lib/dpkg/info/${pkg}.${name}"; do
+    if [ -f "$f" ]; then
+      echo "$f"
+      return 0
+    fi
+  done
+  return 1
+}
+
+# Print the sorted md5sums of the files in a .deb
+deb_md5sums() {
+  dpkg-deb --info "$1" md5sums 2>/dev/null | sort
+}
+
+# Print the sorted md5sums dpkg recorded for an installed package
+installed_md5sums() {
+  local f
+  f=$(dpkg_info_file "$1" "$2" md5sums) || return 1
+  sort "$f"
+}
+
+# Print "<path> <md5>" for each conffile shipped in a .deb. dh_md5sums leaves
+# conffiles out of the md5sums member, so they are hashed separately. All
+# conffiles are extracted in one pass, decompressing the data archive once.
+deb_conffile_sums() {
+  local deb="$1" tmp conffile sum
+  local -a conffiles
+  mapfile -t conffiles < <(dpkg-deb --info "$deb" conffiles 2>/dev/null | awk 'NF {print $NF}')
+  [ ${#conffiles[@]} -gt 0 ] || return 0
 
-sudo dpkg -i ./libvppinfra_${ver}.deb
-sudo dpkg -i ./libvppinfra-dev_${ver}.deb
-sudo dpkg -i ./vpp_${ver}.deb
-sudo dpkg -i ./vpp-dev_${ver}.deb
-sudo dpkg -i ./vpp-crypto-engines_${ver}.deb
-sudo dpkg -i ./vpp-plugin-core_${ver}.deb
-sudo dpkg -i ./vpp-plugin-devtools_${ver}.deb
-sudo dpkg -i ./vpp-plugin-dpdk_${ver}.deb
+  tmp=$(mktemp -d)
+  dpkg-deb --fsys-tarfile "$deb" | tar -xf - -C "$tmp" "${conffiles[@]/#/.}" 2>/dev/null || true
+  for conffile in "${conffiles[@]}"; do
+    # a conffile missing from the archive hashes as empty and never matches
+    sum=""
+    if [ -f "${tmp}${conffile}" ]; then
+      sum=$(md5sum < "${tmp}${conffile}" | cut -d' ' -f1)
+    fi
+    echo "$conffile $sum"
+  done | sort
+  rm -rf "$tmp"
+}
+
+# Print "<path> <md5>" for each conffile dpkg recorded for an installed package.
+# These are the hashes of the files as shipped, not of local edits.
+installed_conffile_sums() {
+  dpkg-query --show --showformat='${Conffiles}\n' "$1" 2>/dev/null |
+    awk 'NF >= 2 && $3 != "obsolete" {print $1, $2}' | sort
+}
+
+# Succeed if the maintainer scripts in the .deb match the installed ones
+same_maintainer_scripts() {
+  local deb="$1" pkg="$2" arch="$3" script f
+  for script in preinst postinst prerm postrm; do
+    if f=$(dpkg_info_file "$pkg" "$arch" "$script"); then
+      dpkg-deb --info "$deb" "$script" 2>/dev/null | cmp -s - "$f" || return 1
+    elif dpkg-deb --info "$deb" "$script" >/dev/null 2>&1; then
+      return 1
+    fi
+  done
+}
+
+# Succeed if the .deb is already installed with the same version and contents.
+# Version strings alone are not enough: local rebuilds often reuse them.
+# Compared: version, file md5sums, conffile md5sums and maintainer scripts.
+# Not compared: other control fields (e.g. Depends) and triggers.
+is_installed() {
+  local deb="$1" pkg version arch status installed_ver new_sums old_sums
+  pkg=$(dpkg-deb --field "$deb" Package)
+  version=$(dpkg-deb --field "$deb" Version)
+  arch=$(dpkg-deb --field "$deb" Architecture)
+
+  local query="$pkg"
+  if [[ "$arch" != "all" ]]; then
+    query="${pkg}:${arch}"
+  fi
+
+  status=$(dpkg-query --show --showformat='${Status}\t${Version}' "$query" 2>/dev/null) || return 1
+  installed_ver="${status#*$'\t'}"
+  [[ "${status%%$'\t'*}" == "install ok installed" ]] || return 1
+  [[ "$installed_ver" == "$version" ]] || return 1
+
+  new_sums=$(deb_md5sums "$deb")
+  old_sums=$(installed_md5sums "$pkg" "$arch") || return 1
+  [[ -n "$new_sums" && "$new_sums" == "$old_sums" ]] || return 1
+
+  [[ "$(deb_conffile_sums "$deb")" == "$(installed_conffile_sums "$query")" ]] || return 1
+  same_maintainer_scripts "$deb" "$pkg" "$arch"
+}
+
+#######################################
+# Main: work out what changed
+#######################################
+echo "Checking VPP packages with version: $ver"
+
+TO_INSTALL=()
+RESTART_NEEDED=false
+for pkg in "${PACKAGES[@]}"; do
+  deb="./${pkg}_${ver}.deb"
+  if [ ! -f "$deb" ]; then
+    echo "ERROR: $deb not found"
+    exit 1
+  fi
+  if [ "$FORCE" = false ] && is_installed "$deb"; then
+    echo "  $pkg: unchanged, skipping"
+    continue
+  fi
+  echo "  $pkg: will install"
+  TO_INSTALL+=("$deb")
+  # Headers only; a running VPP is unaffected
+  if [[ "$pkg" != *-dev ]]; then
+    RESTART_NEEDED=true
+  fi
+done
+
+if [ ${#TO_INSTALL[@]} -eq 0 ]; then
+  echo "All VPP packages are up to date."
+  exit 0
+fi
+
+if [ "$DRY_RUN" = true ]; then
+  echo "Dry run: would install ${#TO_INSTALL[@]} package(s)."
+  exit 0
+fi
+
+#######################################
+# Install in one transaction, stopping VPP only if it is affected
+#######################################
+VPP_WAS_RUNNING=false
+if [ "$RESTART_NEEDED" = true ] && systemctl is-active --quiet vpp 2>/dev/null; then
+  VPP_WAS_RUNNING=true
+  echo "Stopping VPP..."
+  sudo systemctl stop vpp
+fi
+
+echo "Installing ${#TO_INSTALL[@]} package(s)..."
+if ! sudo dpkg -i "${TO_INSTALL[@]}"; then
+  echo "ERROR: dpkg failed" >&2
+  if [ "$VPP_WAS_RUNNING" = true ]; then
+    echo "Attempting to restart VPP..." >&2
+    sudo systemctl start vpp || true
+  fi
+  exit 1
+fi
+
+if [ "$VPP_WAS_RUNNING" = true ]; then
+  echo "Restarting VPP..."
+  sudo systemctl start vpp
+fi
@@ -0,0 +1,607 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-3-Clause
+#
+'''Turn production pcaps into VPP packet-generator replay streams.
+
+The capture is read through mmap one record at a time, so multi-gigabyte
+files are never loaded whole. Packets can be sliced by time and by flow,
+have their MAC/IPv4 addresses rewritten to match the test topology, and be
+split into one pcap per worker (symmetric flow hash) or per RSS queue
+(Toeplitz hash, as the NIC would compute it). A .vpp file with one
+"packet-generator new { ... pcap ... }" stanza per output pcap is written
+alongside, with the rate divided between streams in proportion to their
+packet counts.
+
+Only classic pcap files with Ethernet link type are supported; convert
+pcapng first with "editcap -F pcap". Nanosecond and big-endian input is
+accepted, but output is always native-order with microsecond timestamps,
+the only form VPP's pcap reader loads.
+'''
+
+import sys
+import os
+import mmap
+import zlib
+import struct
+import argparse
+import ipaddress
+
+from functools import lru_cache
+
+# magic -> (byte order, timestamp fraction scale)
+PCAP_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+# VPP's pcap_read only accepts native-order microsecond files, so every
+# output uses this magic whatever the input was
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+LINKTYPE_ETHERNET = 1
+PCAP_HDR_LEN = 24
+REC_HDR_LEN = 16
+
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86dd
+VLAN_TPIDS = (0x8100, 0x88a8)
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+# Default RSS key used by most NIC drivers (and DPDK testpmd)
+DEFAULT_RSS_KEY = bytes.fromhex(
+    "6d5a56da255b0ec24167253d43a38fb0d0ca2bcbae7b30b4"
+    "77cb2da38030f20c6a42b73bbeac01fa")
+RSS_KEY_MIN_LEN = 40
+
+
+class PcapReader:
+    '''Iterate over the records of a pcap file through mmap. Yields
+    (ts_sec, ts_frac, data, orig_len) where data is a memoryview into the
+    map and ts_frac is in units of ts_scale seconds.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("%s is empty" % path)
+        magic = self._map[:4]
+        if magic == PCAPNG_MAGIC:
+            self.close()
+            raise ValueError("%s is pcapng; convert it with 'editcap -F pcap'"
+                             % path)
+        if magic not in PCAP_MAGICS or len(self._map) < PCAP_HDR_LEN:
+            self.close()
+            raise ValueError("%s is not a pcap file" % path)
+        self.order, self.ts_scale = PCAP_MAGICS[magic]
+        (self.version_major, self.version_minor, _, _, self.snaplen,
+         self.linktype) = struct.unpack_from(self.order + "HHiIII", self._map, 4)
+        self._rec = struct.Struct(self.order + "IIII")
+
+    def __iter__(self):
+        view = memoryview(self._map)
+        off = PCAP_HDR_LEN
+        end = len(self._map)
+        unpack = self._rec.unpack_from
+        try:
+            while off + REC_HDR_LEN <= end:
+                ts_sec, ts_frac, incl_len, orig_len = unpack(self._map, off)
+                off += REC_HDR_LEN
+                if off + incl_len > end:
+                    print("Warning: %s is truncated" % self.path, file=sys.stderr)
+                    break
+                data = view[off:off + incl_len]
+                try:
+                    yield ts_sec, ts_frac, data, orig_len
+                finally:
+                    # the map cannot be closed while record views are alive
+                    data.release()
+                off += incl_len
+        finally:
+            view.release()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Packet:
+    '''Header offsets of an Ethernet frame, enough to identify its flow and
+    rewrite its addresses'''
+
+    __slots__ = ("buf", "l3", "version", "proto", "l4", "src", "dst",
+                 "sport", "dport")
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.l3 = self.version = self.proto = self.l4 = None
+        self.src = self.dst = None
+        self.sport = self.dport = 0
+        if len(buf) < 14:
+            return
+        off = 12
+        ethertype = struct.unpack_from("!H", buf, off)[0]
+        while ethertype in VLAN_TPIDS and len(buf) >= off + 6:
+            off += 4
+            ethertype = struct.unpack_from("!H", buf, off)[0]
+        off += 2
+        if ethertype == ETH_P_IP and len(buf) >= off + 20:
+            ihl = (buf[off] & 0x0f) * 4
+            self.l3, self.version = off, 4
+            self.proto = buf[off + 9]
+            self.src = bytes(buf[off + 12:off + 16])
+            self.dst = bytes(buf[off + 16:off + 20])
+            # only the first fragment carries the L4 header
+            if struct.unpack_from("!H", buf, off + 6)[0] & 0x1fff == 0:
+                self.l4 = off + ihl
+        elif ethertype == ETH_P_IPV6 and len(buf) >= off + 40:
+            self.l3, self.version = off, 6
+            self.proto = buf[off + 6]
+            self.src = bytes(buf[off + 8:off + 24])
+            self.dst = bytes(buf[off + 24:off + 40])
+            self.l4 = off + 40
+        if self.proto in (IPPROTO_TCP, IPPROTO_UDP) and self.l4 is not None \
+                and len(buf) >= self.l4 + 4:
+            self.sport, self.dport = struct.unpack_from("!HH", buf, self.l4)
+        else:
+            self.l4 = None
+
+    def flow(self):
+        '''Direction-independent flow key, the same for both sides of a
+        connection, or None for non-IP frames'''
+        if self.l3 is None:
+            return None
+        a = self.src + struct.pack("!H", self.sport)
+        b = self.dst + struct.pack("!H", self.dport)
+        return bytes([self.proto]) + min(a, b) + max(a, b)
+
+
+def _csum_fold(s):
+    while s >> 16:
+        s = (s & 0xffff) + (s >> 16)
+    return s
+
+
+def _csum_update(csum, old, new):
+    '''Incrementally update a ones-complement checksum (RFC 1624) for a
+    change of "old" to "new", both an even number of bytes long'''
+    s = ~csum & 0xffff
+    for i in range(0, len(old), 2):
+        s += (~((old[i] << 8) | old[i + 1])) & 0xffff
+        s += (new[i] << 8) | new[i + 1]
+    return ~_csum_fold(s) & 0xffff
+
+
+class Rewriter:
+    '''Rewrite MAC and IPv4 addresses. Addresses are mapped into the target
+    prefix keeping their host bits, so the flow distribution survives.
+
+    Address mapping is direction-aware: the side that sent the first packet
+    of a connection is mapped into src_net and its peer into dst_net, for
+    both directions, so replies stay part of the same connection.'''
+
+    def __init__(self, src_mac=None, dst_mac=None, src_net=None, dst_net=None):
+        self.src_mac = src_mac
+        self.dst_mac = dst_mac
+        self.src_net = self._prefix(src_net)
+        self.dst_net = self._prefix(dst_net)
+        # flow key -> (address, port) of the connection initiator
+        self.initiators = {}
+
+    @staticmethod
+    def _prefix(net):
+        if net is None:
+            return None
+        return (int(net.network_address), int(net.netmask))
+
+    @staticmethod
+    def _map(addr, prefix):
+        if prefix is None:
+            return addr
+        net, mask = prefix
+        value = (int.from_bytes(addr, "big") & ~mask & 0xffffffff) | net
+        return value.to_bytes(4, "big")
+
+    def enabled(self):
+        return any((self.src_mac, self.dst_mac, self.src_net, self.dst_net))
+
+    def rewrite(self, pkt):
+        '''Rewrite pkt.buf (a bytearray) in place, fixing checksums'''
+        buf = pkt.buf
+        if self.dst_mac:
+            buf[0:6] = self.dst_mac
+        if self.src_mac:
+            buf[6:12] = self.src_mac
+        if pkt.version != 4 or not (self.src_net or self.dst_net):
+            return
+
+        l3 = pkt.l3
+        old = pkt.src + pkt.dst
+        initiator = self.initiators.setdefault(pkt.flow(), (pkt.src, pkt.sport))
+        if initiator == (pkt.src, pkt.sport):
+            src_net, dst_net = self.src_net, self.dst_net
+        else:
+            src_net, dst_net = self.dst_net, self.src_net
+        pkt.src = self._map(pkt.src, src_net)
+        pkt.dst = self._map(pkt.dst, dst_net)
+        new = pkt.src + pkt.dst
+        if old == new:
+            return
+        buf[l3 + 12:l3 + 20] = new
+
+        # IPv4 header checksum
+        ip_csum = struct.unpack_from("!H", buf, l3 + 10)[0]
+        struct.pack_into("!H", buf, l3 + 10, _csum_update(ip_csum, old, new))
+
+        # TCP/UDP checksums cover the pseudo header addresses too
+        if pkt.l4 is None:
+            return
+        csum_off = pkt.l4 + (16 if pkt.proto == IPPROTO_TCP else 6)
+        if len(buf) < csum_off + 2:
+            return
+        l4_csum = struct.unpack_from("!H", buf, csum_off)[0]
+        if pkt.proto == IPPROTO_UDP and l4_csum == 0:
+            return  # checksum not in use
+        l4_csum = _csum_update(l4_csum, old, new)
+        if pkt.proto == IPPROTO_UDP and l4_csum == 0:
+            l4_csum = 0xffff
+        struct.pack_into("!H", buf, csum_off, l4_csum)
+
+
+class FlowSplitter:
+    '''Assign packets to workers by a symmetric flow hash, so both
+    directions of a connection land on the same worker'''
+
+    def __init__(self, count):
+        self.count = count
+
+    def index(self, pkt):
+        if pkt.l3 is None:
+            return 0
+        return zlib.crc32(pkt.flow()) % self.count
+
+
+class RssSplitter:
+    '''Assign packets to receive queues the way a NIC does: Toeplitz hash of
+    addresses and ports, looked up in a round-robin indirection table'''
+
+    def __init__(self, count, key=DEFAULT_RSS_KEY, reta_size=128):
+        self.count = count
+        self.reta = [i % count for i in range(reta_size)]
+        self.key = int.from_bytes(key, "big")
+        self.key_bits = len(key) * 8
+        self.hash = lru_cache(maxsize=65536)(self._toeplitz)
+
+    def _toeplitz(self, data):
+        result = 0
+        key, shift = self.key, self.key_bits - 32
+        for byte in data:
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    result ^= (key >> shift) & 0xffffffff
+                shift -= 1
+        return result
+
+    def index(self, pkt):
+        if pkt.l3 is None:
+            return 0
+        data = pkt.src + pkt.dst
+        if pkt.l4 is not None:
+            data += struct.pack("!HH", pkt.sport, pkt.dport)
+        return self.reta[self.hash(data) % len(self.reta)]
+
+
+class FlowFilter:
+    '''Select packets by protocol, port, address and first-N flows'''
+
+    def __init__(self, proto=None, port=None, nets=None, max_flows=None):
+        self.proto = proto
+        self.port = port
+        self.nets = nets or []
+        self.max_flows = max_flows
+        self.flows = set()
+
+    def _addr_match(self, pkt):
+        for net in self.nets:
+            for addr in (pkt.src, pkt.dst):
+                if len(addr) * 8 == net.max_prefixlen and \
+                        ipaddress.ip_address(addr) in net:
+                    return True
+        return False
+
+    def match(self, pkt):
+        if self.proto is not None and pkt.proto != self.proto:
+            return False
+        if self.port is not None and self.port not in (pkt.sport, pkt.dport):
+            return False
+        if self.nets and (pkt.l3 is None or not self._addr_match(pkt)):
+            return False
+        if self.max_flows is not None:
+            flow = pkt.flow()
+            if flow not in self.flows:
+                if len(self.flows) >= self.max_flows:
+                    return False
+                self.flows.add(flow)
+        return True
+
+
+def pg_stanza(name, pcap, interface, node, limit, rate, worker):
+    '''Format one packet-generator stream the way the .vpp files in this
+    repo lay them out'''
+    lines = ["packet-generator new {",
+             "   name %s" % name,
+             "   limit %d" % limit]
+    if rate:
+        lines.append("   rate %.6g" % rate)
+    lines += ["   interface %s" % interface,
+              "   node %s" % node,
+              "   pcap %s" % pcap]
+    if worker is not None:
+        lines.append("   worker %d" % worker)
+    width = max(len(line) for line in lines) + 2
+    return "\n".join(line.ljust(width) + "\\" for line in lines) + "\n}\n"
+
+
+def parse_mac(value):
+    try:
+        mac = bytes.fromhex(value.replace(":", "").replace("-", ""))
+    except ValueError:
+        mac = b""
+    if len(mac) != 6:
+        raise argparse.ArgumentTypeError("invalid MAC address: %s" % value)
+    return mac
+
+
+def parse_ipv4_net(value):
+    try:
+        return ipaddress.IPv4Network(value, strict=False)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+def parse_net(value):
+    try:
+        return ipaddress.ip_network(value, strict=False)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+def parse_proto(value):
+    names = {"tcp": IPPROTO_TCP, "udp": IPPROTO_UDP}
+    if value.lower() in names:
+        return names[value.lower()]
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid protocol: %s" % value)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Slice, rewrite and split pcaps into VPP packet-generator replay streams',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+---------
+
+Replay the first 10 seconds of a capture on eth0, addressed to the test topology:
+        %(prog)s --duration 10 --src-mac 00:1c:42:17:cb:ca --dst-mac 02:fe:9d:a7:ae:39 \\
+                 --src-net 10.37.129.0/24 --dst-net 10.37.130.0/24 prod.pcap
+
+Keep 1000 UDP flows and split them over 4 RSS queues at 2 Mpps in total:
+        %(prog)s --proto udp --flows 1000 --split 4 --split-by rss --rate 2e6 prod.pcap
+
+Load the streams in VPP:
+        vppctl exec /path/to/replay.vpp
+""")
+    parser.add_argument('pcap', help="Input capture (classic pcap)")
+
+    group = parser.add_argument_group('slicing')
+    group.add_argument('--start', type=float, default=0.0,
+                       help="Skip the first START seconds of the capture, "
+                            "measured from the first record's timestamp")
+    group.add_argument('--duration', type=float,
+                       help="Keep DURATION seconds after --start (end excluded)")
+    group.add_argument('--reorder-slack', type=float, default=1.0,
+                       help="Keep scanning this many seconds past the window "
+                            "for out-of-order packets before stopping "
+                            "(default: 1.0)")
+    group.add_argument('--proto', type=parse_proto,
+                       help="Keep only this IP protocol (tcp, udp or a number)")
+    group.add_argument('--port', type=int,
+                       help="Keep only packets with this source or destination port")
+    group.add_argument('--net', type=parse_net, action='append',
+                       help="Keep only packets to or from this prefix (repeatable)")
+    group.add_argument('--flows', type=int,
+                       help="Keep only the first FLOWS connections (both directions)")
+    group.add_argument('--max-packets', type=int,
+                       help="Stop after writing this many packets")
+
+    group = parser.add_argument_group('rewriting')
+    group.add_argument('--src-mac', type=parse_mac, help="Set the source MAC")
+    group.add_argument('--dst-mac', type=parse_mac, help="Set the destination MAC")
+    group.add_argument('--src-net', type=parse_ipv4_net,
+                       help="Map each connection's initiator into this prefix, "
+                            "keeping host bits (replies are mapped to match)")
+    group.add_argument('--dst-net', type=parse_ipv4_net,
+                       help="Map each connection's responder into this prefix, "
+                            "keeping host bits (replies are mapped to match)")
+
+    group = parser.add_argument_group('splitting')
+    group.add_argument('--split', type=int, default=1,
+                       help="Number of output streams (default: 1)")
+    group.add_argument('--split-by', choices=('flow', 'rss'), default='flow',
+                       help="Symmetric flow hash per worker, or Toeplitz hash per "
+                            "RSS queue (default: flow)")
+    group.add_argument('--rss-key', type=bytes.fromhex,
+                       default=DEFAULT_RSS_KEY,
+                       help="RSS key in hex, at least 40 bytes (default: the "
+                            "common 40 byte key)")
+    group.add_argument('--reta-size', type=int, default=128,
+                       help="RSS indirection table size (default: 128)")
+
+    group = parser.add_argument_group('packet-generator')
+    group.add_argument('-o', '--out-dir', default='.',
+                       help="Directory for the pcaps and .vpp file (default: .)")
+    group.add_argument('-n', '--name', default='replay',
+                       help="Stream and file name prefix (default: replay)")
+    group.add_argument('--interface', default='eth0',
+                       help="pg RX interface (default: eth0)")
+    group.add_argument('--node', default='ethernet-input',
+                       help="pg input node (default: ethernet-input)")
+    group.add_argument('--rate', type=float,
+                       help="Aggregate rate in packets/s, divided over streams")
+    group.add_argument('--loops', type=int, default=1,
+                       help="Replay each pcap this many times (default: 1)")
+    group.add_argument('--limit', type=int,
+                       help="Packets per stream; overrides --loops")
+
+    opt = parser.parse_args()
+    if opt.split < 1:
+        parser.error("--split must be at least 1")
+    if opt.loops < 1:
+        parser.error("--loops must be at least 1")
+    if opt.reorder_slack < 0:
+        parser.error("--reorder-slack must not be negative")
+    for name in ('max_packets', 'flows', 'limit'):
+        if getattr(opt, name) is not None and getattr(opt, name) < 1:
+            parser.error("--%s must be at least 1" % name.replace('_', '-'))
+    if opt.split_by == 'rss' and opt.reta_size < opt.split:
+        parser.error("--reta-size must be at least --split (%d), or some "
+                     "queues would never be used" % opt.split)
+    # the Toeplitz window must cover the longest input (IPv6 addresses and
+    # ports, 36 bytes) plus 4 bytes
+    if len(opt.rss_key) < RSS_KEY_MIN_LEN:
+        parser.error("--rss-key must be at least %d bytes, got %d"
+                     % (RSS_KEY_MIN_LEN, len(opt.rss_key)))
+    return opt
+
+
+def main():
+    '''program main function'''
+    opt = parse_args()
+
+    try:
+        reader = PcapReader(opt.pcap)
+    except (OSError, ValueError) as err:
+        sys.exit("Error: %s" % err)
+
+    with reader:
+        if reader.linktype != LINKTYPE_ETHERNET:
+            sys.exit("Error: %s has link type %d, only Ethernet is supported"
+                     % (opt.pcap, reader.linktype))
+
+        flow_filter = FlowFilter(opt.proto, opt.port, opt.net, opt.flows)
+        rewriter = Rewriter(opt.src_mac, opt.dst_mac, opt.src_net, opt.dst_net)
+        splitter = None
+        if opt.split > 1:
+            if opt.split_by == 'rss':
+                splitter = RssSplitter(opt.split, opt.rss_key, opt.reta_size)
+            else:
+                splitter = FlowSplitter(opt.split)
+
+        os.makedirs(opt.out_dir, exist_ok=True)
+        if splitter:
+            names = ["%s%d" % (opt.name, i) for i in range(opt.split)]
+        else:
+            names = [opt.name]
+        paths = [os.path.abspath(os.path.join(opt.out_dir, n + ".pcap"))
+                 for n in names]
+        outputs = [open(p, "wb") for p in paths]
+        counts = [0] * len(outputs)
+        header = struct.pack("=IHHiIII", PCAP_MAGIC_USEC, 2, 4, 0, 0,
+                             reader.snaplen, reader.linktype)
+        for out in outputs:
+            out.write(header)
+        rec = struct.Struct("=IIII")
+        usec_div = 1000 if reader.ts_scale == 1e-9 else 1
+
+        # the window [start, start + duration) in timestamp units, compared
+        # as integers so boundary packets are not subject to float rounding
+        units = 10 ** 9 if reader.ts_scale == 1e-9 else 10 ** 6
+        start = int(round(opt.start * units))
+        end = stop = None
+        if opt.duration is not None:
+            end = start + int(round(opt.duration * units))
+            stop = end + int(round(opt.reorder_slack * units))
+
+        first_ts = None
+        written = 0
+        try:
+            for ts_sec, ts_frac, data, orig_len in reader:
+                ts = ts_sec * units + ts_frac
+                if first_ts is None:
+                    first_ts = ts
+                rel = ts - first_ts
+                # merged and multi-queue captures are only roughly in time
+                # order: packets stamped before the first record still count
+                # as inside a window that starts at 0, and scanning goes on
+                # for --reorder-slack past the window before giving up on
+                # the remainder of the file
+                if start and rel < start:
+                    continue
+                if end is not None and rel >= end:
+                    if rel >= stop:
+                        break
+                    continue
+
+                pkt = Packet(data)
+                if not flow_filter.match(pkt):
+                    continue
+                # workers are chosen from the original addresses; RSS queues
+                # from the rewritten ones, which is what the NIC will hash
+                idx = 0
+                if isinstance(splitter, FlowSplitter):
+                    idx = splitter.index(pkt)
+                if rewriter.enabled():
+                    pkt.buf = data = bytearray(data)
+                    rewriter.rewrite(pkt)
+                if isinstance(splitter, RssSplitter):
+                    idx = splitter.index(pkt)
+
+                outputs[idx].write(rec.pack(ts_sec, ts_frac // usec_div,
+                                            len(data), orig_len))
+                outputs[idx].write(data)
+                counts[idx] += 1
+                written += 1
+                if opt.max_packets is not None and written >= opt.max_packets:
+                    break
+        finally:
+            for out in outputs:
+                out.close()
+
+    if not written:
+        for p in paths:
+            os.remove(p)
+        sys.exit("Error: no packets matched")
+
+    stanzas = []
+    for i, (name, path, count) in enumerate(zip(names, paths, counts)):
+        if not count:
+            os.remove(path)
+            print("Notice: %s received no packets, skipped" % name, file=sys.stderr)
+            continue
+        rate = opt.rate * count / written if opt.rate else None
+        limit = opt.limit if opt.limit is not None else count * opt.loops
+        stanzas.append(pg_stanza(name, path, opt.interface, opt.node, limit,
+                                 rate, i if splitter else None))
+
+    vpp_file = os.path.join(opt.out_dir, opt.name + ".vpp")
+    with open(vpp_file, "w") as f:
+        f.write("\n".join(stanzas))
+    print("Info: wrote %d packets in %d streams, stanzas in %s"
+          % (written, len(stanzas), vpp_file))
+
+
+if __name__ == "__main__":
+    main()